@@ -1,34 +1,114 @@
 import json
+import time
 import httpx
 import re
-from config import LITELLM_URL, LITELLM_MODEL, LITELLM_KEY, HA_URL, HA_TOKEN
+import logging
+from collections import OrderedDict
+import ha_index
+from config import (
+    LITELLM_URL, LITELLM_MODEL, LITELLM_KEY, HA_URL, HA_TOKEN,
+    LLM_CACHE_TTL_SEC, LLM_CACHE_MAX_ENTRIES,
+)
 
-def build_system_prompt(room: str) -> str:
-    return f"""
-Du är en lokal röstassistent i rummet \"{room}\".
+logger = logging.getLogger(__name__)
+
+# Statisk del först så att LLM-servern kan återanvända prefix-/KV-cachen
+# mellan rum. Allt rumsberoende läggs sist i build_system_prompt.
+STATIC_PROMPT = """
+Du är en lokal röstassistent.
 Om användaren försöker styra hemmet ska du svara med strikt JSON:
-{{
+{
  "action":"homeassistant.call_service",
  "domain":"<domain>",
  "service":"<service>",
  "entity_id":"<entity_id>",
  "reply":"<vad du ska säga till användaren>"
-}}
+}
 
 Annars svarar du strikt JSON:
-{{
+{
  "action":"say",
  "reply":"<vad du ska säga till användaren>"
-}}
+}
 
 VIKTIGT:
 - Svara bara med ett (1) JSON-objekt.
 - Inga förklaringar, ingen tankegång, inget <think>. Inget utanför JSON.
 - Svara kortfattat.
 - Svara på svenska.
+- Använd bara entity_id från listan nedan om en lista finns.
 """.strip()
 
+# _room_prompts[room] = (ha_index.index_version, prompt)
+# room kommer från klienterna (hello, /ask) så cachen är begränsad (LRU).
+ROOM_PROMPT_CACHE_MAX = 64
+_room_prompts = OrderedDict()
+
+# _response_cache[(normaliserad text, room, index_version)] = (expires_at, action_obj)
+# Töms när entitetsindexet ändras (ett "say"-svar kan bero på vilka enheter som finns).
+_response_cache = OrderedDict()
+_response_cache_version = None
+
+def build_system_prompt(room: str) -> str:
+    """
+    Systemprompt för rummet. Byggs en gång per rum och byggs bara om när
+    entitetsindexet ändrats.
+    """
+    cached = _room_prompts.get(room)
+    if cached and cached[0] == ha_index.index_version:
+        _room_prompts.move_to_end(room)
+        return cached[1]
+
+    prompt = STATIC_PROMPT + f"\n\nDu befinner dig i rummet \"{room}\"."
+    entity_list = ha_index.format_entities_for_prompt(room)
+    if entity_list:
+        prompt += "\n" + entity_list
+
+    _room_prompts[room] = (ha_index.index_version, prompt)
+    _room_prompts.move_to_end(room)
+    while len(_room_prompts) > ROOM_PROMPT_CACHE_MAX:
+        _room_prompts.popitem(last=False)
+    return prompt
+
+def _normalize_utterance(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+def _cache_get(key):
+    global _response_cache_version
+    if _response_cache_version != ha_index.index_version:
+        _response_cache.clear()
+        _response_cache_version = ha_index.index_version
+        return None
+
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, action_obj = entry
+    if expires_at < time.monotonic():
+        del _response_cache[key]
+        return None
+    _response_cache.move_to_end(key)
+    return dict(action_obj)
+
+def _cache_put(key, action_obj: dict):
+    # Bara rena "say"-svar; allt som styr hemmet ska alltid gå till LLM:en
+    if action_obj.get("action") != "say" or not action_obj.get("reply"):
+        return
+    _response_cache[key] = (time.monotonic() + LLM_CACHE_TTL_SEC, dict(action_obj))
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > LLM_CACHE_MAX_ENTRIES:
+        _response_cache.popitem(last=False)
+
 async def ask_llm(user_text: str, room: str) -> dict:
+    # index_version tas före anropet så att ett svar som räknats fram mot
+    # ett äldre index aldrig sparas under det nya
+    cache_key = (_normalize_utterance(user_text), room, ha_index.index_version)
+    if LLM_CACHE_TTL_SEC > 0:
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            logger.info(f"LLM cache hit for '{cache_key[0]}' in {room}")
+            return cached
+
     headers = {"Content-Type": "application/json"}
     if LITELLM_KEY:
         headers["Authorization"] = f"Bearer {LITELLM_KEY}"
@@ -51,11 +131,15 @@ async def ask_llm(user_text: str, room: str) -> dict:
         return {"action": "say", "reply": "Jag förstod inte riktigt."}
 
     try:
-        return json.loads(m.group(0))
+        action_obj = json.loads(m.group(0))
     except Exception:
         return {"action": "say", "reply": "Jag förstod inte riktigt."}
 
-async def call_home_assistant_if_needed(action_obj: dict):
+    if LLM_CACHE_TTL_SEC > 0 and isinstance(action_obj, dict):
+        _cache_put(cache_key, action_obj)
+    return action_obj
+
+async def call_home_assistant_if_needed(action_obj: dict, room: str = ""):
     if action_obj.get("action") != "homeassistant.call_service":
         return
 
@@ -65,6 +149,17 @@ async def call_home_assistant_if_needed(action_obj: dict):
     if not (domain and service and entity_id):
         return
 
+    # Validera/rätta entity_id mot indexet innan vi anropar HA
+    requested = entity_id if isinstance(entity_id, list) else [entity_id]
+    resolved = [ha_index.resolve_entity_id(str(eid), domain, room) for eid in requested]
+    if None in resolved:
+        unknown = [eid for eid, r in zip(requested, resolved) if r is None]
+        logger.warning(f"Unknown entity_id {unknown}, skipping HA call")
+        action_obj["reply"] = "Jag hittar ingen sådan enhet."
+        return
+    entity_id = resolved if isinstance(entity_id, list) else resolved[0]
+    action_obj["entity_id"] = entity_id
+
     url = f"{HA_URL}/api/services/{domain}/{service}"
     headers = {
         "Authorization": f"Bearer {HA_TOKEN}",
@@ -5,10 +5,40 @@ LITELLM_URL = os.getenv("LITELLM_URL", "http://litellm:4000/v1/chat/completions"
 LITELLM_MODEL = os.getenv("LITELLM_MODEL", "your-fast-model")
 LITELLM_KEY = os.getenv("LITELLM_KEY", "")
 
+# Svarscache för "say"-svar (0 = avstängd)
+LLM_CACHE_TTL_SEC = float(os.getenv("LLM_CACHE_TTL_SEC", "0"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "256"))
+
 # Home Assistant
 HA_URL = os.getenv("HA_URL", "http://homeassistant:8123")
 HA_TOKEN = os.getenv("HA_TOKEN", "CHANGE_ME")
 
+# Entity-index (hålls i minnet och uppdateras via HA:s event-ström)
+HA_ENTITY_INDEX = os.getenv("HA_ENTITY_INDEX", "true").lower() == "true"
+HA_ENTITY_DOMAINS = [
+    d.strip() for d in os.getenv(
+        "HA_ENTITY_DOMAINS",
+        "light,switch,cover,climate,fan,media_player,lock,scene,script,vacuum",
+    ).split(",") if d.strip()
+]
+HA_PROMPT_MAX_ENTITIES = int(os.getenv("HA_PROMPT_MAX_ENTITIES", "40"))
+HA_RECONNECT_DELAY_SEC = float(os.getenv("HA_RECONNECT_DELAY_SEC", "5"))
+
+# WebSocket-anslutningar (ESP32)
+WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", "500"))
+WS_MAX_ACTIVE_RECORDINGS = int(os.getenv("WS_MAX_ACTIVE_RECORDINGS", "20"))
+WS_PING_INTERVAL_SEC = float(os.getenv("WS_PING_INTERVAL_SEC", "30"))
+# Sockets som inte skickat "hello" inom så här lång tid stängs
+WS_HELLO_TIMEOUT_SEC = float(os.getenv("WS_HELLO_TIMEOUT_SEC", "10"))
+# Enheter med heartbeat (se websocket_handler) som inte hörts av på så här
+# länge kopplas ner (0 = aldrig). Äldre firmware utan pong berörs inte.
+WS_IDLE_TIMEOUT_SEC = float(os.getenv("WS_IDLE_TIMEOUT_SEC", "0"))
+
+# Inspelning av sessioner för offline-replay (tom = avstängt)
+RECORD_DIR = os.getenv("RECORD_DIR", "")
+# Äldsta inspelningarna tas bort när RECORD_DIR blir större än så här (0 = obegränsat)
+RECORD_MAX_MB = float(os.getenv("RECORD_MAX_MB", "2048"))
+
 # Whisper (STT)
 WHISPER_MODEL_NAME = os.getenv("WHISPER_MODEL_NAME", "tiny")
 
@@ -0,0 +1,344 @@
+import re
+import json
+import asyncio
+import difflib
+import logging
+from typing import Dict, List, Optional
+
+import websockets
+
+from config import (
+    HA_URL, HA_TOKEN,
+    HA_ENTITY_INDEX, HA_ENTITY_DOMAINS,
+    HA_PROMPT_MAX_ENTITIES, HA_RECONNECT_DELAY_SEC,
+)
+
+logger = logging.getLogger(__name__)
+
+# Index över HA-entiteter, laddas en gång och hålls sedan aktuellt
+# via HA:s websocket-API (state_changed + registry-events).
+# entities[entity_id] = {
+#   "name": "Taklampa kök",
+#   "area_id": "kok",
+#   "state": "on",
+# }
+# areas[area_id] = "Kök"
+entities: Dict[str, dict] = {}
+areas: Dict[str, str] = {}
+
+# Entiteter som filtrerats bort vid laddning (disabled/hidden/entity_category).
+# state_changed för dessa ignoreras så att de inte smiter in i indexet igen.
+_excluded: set = set()
+
+# True när första laddningen lyckats. Därefter behåller vi indexet även
+# om anslutningen till HA tappas (gammal data är bättre än ingen).
+loaded = False
+
+# Räknas upp när mängden entiteter eller deras namn/rum ändras
+# (inte vid rena state-ändringar).
+index_version = 0
+
+_task: Optional[asyncio.Task] = None
+
+_TRANSLIT = str.maketrans({"å": "a", "ä": "a", "ö": "o", "é": "e", "ü": "u"})
+
+
+def normalize(text: str) -> str:
+    """Slugga text ungefär som HA gör: 'Kök Tak' -> 'kok_tak'."""
+    text = text.lower().translate(_TRANSLIT)
+    return re.sub(r"[^a-z0-9]+", "_", text).strip("_")
+
+
+def _tracked(entity_id: str) -> bool:
+    return entity_id.split(".", 1)[0] in HA_ENTITY_DOMAINS
+
+
+def build_index(states: List[dict], area_list: List[dict],
+                entity_list: List[dict], device_list: List[dict]):
+    """
+    Bygg om hela indexet från svaren på get_states och registry-listorna.
+    Rena data in, inga nätverksanrop, så det går att mata med en lokal
+    ersättare för HA.
+    """
+    global loaded, index_version
+
+    device_area = {d["id"]: d.get("area_id") for d in device_list if d.get("id")}
+    registry = {e["entity_id"]: e for e in entity_list if e.get("entity_id")}
+
+    new_entities = {}
+    excluded = set()
+    for st in states:
+        eid = st.get("entity_id", "")
+        if not _tracked(eid):
+            continue
+
+        reg = registry.get(eid, {})
+        if reg.get("disabled_by") or reg.get("hidden_by") or reg.get("entity_category"):
+            excluded.add(eid)
+            continue
+
+        area_id = reg.get("area_id") or device_area.get(reg.get("device_id"))
+        name = (st.get("attributes") or {}).get("friendly_name") or reg.get("name") or eid
+
+        new_entities[eid] = {
+            "name": name,
+            "area_id": area_id,
+            "state": st.get("state"),
+        }
+
+    entities.clear()
+    entities.update(new_entities)
+    _excluded.clear()
+    _excluded.update(excluded)
+    # Registry-poster utan state (t.ex. avstängda) ska heller inte läggas till
+    _excluded.update(
+        eid for eid, reg in registry.items()
+        if reg.get("disabled_by") or reg.get("hidden_by") or reg.get("entity_category")
+    )
+    areas.clear()
+    areas.update({a["area_id"]: a.get("name", a["area_id"]) for a in area_list if a.get("area_id")})
+
+    loaded = True
+    index_version += 1
+    logger.info(f"Entity index loaded: {len(entities)} entities, {len(areas)} areas")
+
+
+def apply_state_change(data: dict):
+    """Uppdatera indexet från ett state_changed-event."""
+    global index_version
+
+    eid = data.get("entity_id", "")
+    if not _tracked(eid) or eid in _excluded:
+        return
+
+    new_state = data.get("new_state")
+    if new_state is None:
+        if entities.pop(eid, None) is not None:
+            index_version += 1
+        return
+
+    name = (new_state.get("attributes") or {}).get("friendly_name") or eid
+    current = entities.get(eid)
+    if current is None:
+        # Ny entitet utan registry-info; rummet fylls i vid nästa omladdning
+        entities[eid] = {"name": name, "area_id": None, "state": new_state.get("state")}
+        index_version += 1
+        return
+
+    current["state"] = new_state.get("state")
+    if current["name"] != name:
+        current["name"] = name
+        index_version += 1
+
+
+def room_area_id(room: str) -> Optional[str]:
+    """Matcha ESP32:ans room mot ett HA-område (på area_id eller namn)."""
+    key = normalize(room or "")
+    if not key:
+        return None
+    for area_id, name in areas.items():
+        if key == area_id or key == normalize(name):
+            return area_id
+    return None
+
+
+def entities_for_room(room: str) -> List[str]:
+    area_id = room_area_id(room)
+    if area_id is None:
+        return []
+    return sorted(eid for eid, e in entities.items() if e["area_id"] == area_id)
+
+
+def _prompt_priority(eid: str):
+    # Domäner i den ordning de står i HA_ENTITY_DOMAINS (lampor först som standard)
+    domain = eid.split(".", 1)[0]
+    rank = HA_ENTITY_DOMAINS.index(domain) if domain in HA_ENTITY_DOMAINS else len(HA_ENTITY_DOMAINS)
+    return rank, eid
+
+
+def format_entities_for_prompt(room: str) -> str:
+    """
+    Kompakt entitetslista för systemprompten. Rummets egna entiteter om
+    rummet matchar ett HA-område, annars hela hemmet grupperat per område.
+    Över HA_PROMPT_MAX_ENTITIES behålls domänerna som står först i
+    HA_ENTITY_DOMAINS.
+    """
+    if not loaded or not entities:
+        return ""
+
+    room_eids = entities_for_room(room)
+    eids = sorted(room_eids or entities, key=_prompt_priority)
+    if len(eids) > HA_PROMPT_MAX_ENTITIES:
+        logger.warning(
+            f"Entity list for room '{room}' truncated to {HA_PROMPT_MAX_ENTITIES} "
+            f"of {len(eids)} entities (HA_PROMPT_MAX_ENTITIES)"
+        )
+        eids = eids[:HA_PROMPT_MAX_ENTITIES]
+
+    if room_eids:
+        lines = ["Enheter i det här rummet (entity_id: namn):"]
+        lines += [f"- {eid}: {entities[eid]['name']}" for eid in sorted(eids)]
+        return "\n".join(lines)
+
+    # Okänt rum: gruppera per område så att LLM:en kan välja rätt rum
+    by_area: Dict[str, List[str]] = {}
+    for eid in eids:
+        area_id = entities[eid]["area_id"]
+        by_area.setdefault(areas.get(area_id, "Utan område"), []).append(eid)
+
+    lines = ["Enheter i hemmet per område (entity_id: namn):"]
+    for area_name in sorted(by_area):
+        lines.append(f"{area_name}:")
+        lines += [f"- {eid}: {entities[eid]['name']}" for eid in sorted(by_area[area_name])]
+    return "\n".join(lines)
+
+
+def _closest(guess: str, candidates: List[str]) -> Optional[str]:
+    if not candidates:
+        return None
+
+    # Jämför både mot object_id ("kok_tak") och mot sluggat namn
+    keys = {}
+    for eid in candidates:
+        keys.setdefault(eid.split(".", 1)[1], eid)
+        keys.setdefault(normalize(entities[eid]["name"]), eid)
+
+    match = difflib.get_close_matches(normalize(guess), list(keys), n=1, cutoff=0.7)
+    return keys[match[0]] if match else None
+
+
+def resolve_entity_id(entity_id: str, domain: Optional[str] = None,
+                      room: str = "") -> Optional[str]:
+    """
+    Validera ett entity_id från LLM:en.
+    - Finns det i indexet returneras det oförändrat.
+    - Annars försöker vi hitta närmaste entitet (först i rummet, sedan i
+      hela hemmet) inom samma domän.
+    - Returnerar None om inget rimligt hittas.
+    Innan indexet är laddat, och för domäner som inte finns i
+    HA_ENTITY_DOMAINS, kan vi inte validera och släpper igenom id:t.
+    """
+    if not loaded:
+        return entity_id
+    if entity_id in entities:
+        return entity_id
+
+    if "." in entity_id:
+        want_domain, guess = entity_id.split(".", 1)
+    else:
+        want_domain, guess = domain, entity_id
+
+    # Otrackade domäner (input_boolean, button, ...) finns inte i indexet
+    if want_domain and want_domain != "homeassistant" and want_domain not in HA_ENTITY_DOMAINS:
+        return entity_id
+
+    same_domain = [
+        eid for eid in entities
+        if not want_domain or want_domain == "homeassistant" or eid.startswith(want_domain + ".")
+    ]
+    room_eids = set(entities_for_room(room))
+
+    resolved = (
+        _closest(guess, [eid for eid in same_domain if eid in room_eids])
+        or _closest(guess, same_domain)
+    )
+    if resolved:
+        logger.info(f"Corrected entity_id '{entity_id}' -> '{resolved}'")
+    return resolved
+
+
+def _ws_url() -> str:
+    base = re.sub(r"^http", "ws", HA_URL.rstrip("/"))
+    return f"{base}/api/websocket"
+
+
+async def _sync_once():
+    """
+    En anslutning mot HA:
+    1. autentisera
+    2. hämta states + area/entity/device-registry och bygg indexet
+    3. prenumerera på state_changed och registry-ändringar
+    Returnerar True vid registry-ändring så att _run laddar om direkt.
+    """
+    async with websockets.connect(_ws_url(), max_size=None) as conn:
+        msg = json.loads(await conn.recv())
+        if msg.get("type") == "auth_required":
+            await conn.send(json.dumps({"type": "auth", "access_token": HA_TOKEN}))
+            msg = json.loads(await conn.recv())
+        if msg.get("type") != "auth_ok":
+            raise RuntimeError(f"HA auth failed: {msg.get('type')}")
+
+        requests = {
+            1: "get_states",
+            2: "config/area_registry/list",
+            3: "config/entity_registry/list",
+            4: "config/device_registry/list",
+        }
+        for req_id, req_type in requests.items():
+            await conn.send(json.dumps({"id": req_id, "type": req_type}))
+
+        results = {}
+        while len(results) < len(requests):
+            msg = json.loads(await conn.recv())
+            if msg.get("type") != "result" or msg.get("id") not in requests:
+                continue
+            if not msg.get("success"):
+                raise RuntimeError(f"HA request {requests[msg['id']]} failed: {msg.get('error')}")
+            results[msg["id"]] = msg.get("result") or []
+
+        build_index(results[1], results[2], results[3], results[4])
+
+        subscriptions = [
+            "state_changed",
+            "area_registry_updated",
+            "entity_registry_updated",
+            "device_registry_updated",
+        ]
+        for i, event_type in enumerate(subscriptions, start=10):
+            await conn.send(json.dumps({"id": i, "type": "subscribe_events", "event_type": event_type}))
+
+        async for raw in conn:
+            msg = json.loads(raw)
+            if msg.get("type") != "event":
+                continue
+
+            event = msg.get("event", {})
+            if event.get("event_type") == "state_changed":
+                apply_state_change(event.get("data", {}))
+            else:
+                logger.info(f"HA {event.get('event_type')}, reloading entity index")
+                return True
+
+    return False
+
+
+async def _run():
+    while True:
+        try:
+            if await _sync_once():
+                continue
+            logger.warning("HA websocket closed, reconnecting")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Entity index sync failed: {e}")
+        await asyncio.sleep(HA_RECONNECT_DELAY_SEC)
+
+
+def start():
+    global _task
+    if not HA_ENTITY_INDEX or _task is not None:
+        return
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
@@ -3,8 +3,9 @@ from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
-from websocket_handler import ws_handler
+from websocket_handler import ws_handler, start_heartbeat, stop_heartbeat
 from routes import router as http_router
+import ha_index
 
 # Configure logging
 logging.basicConfig(
@@ -25,6 +26,18 @@ app.add_middleware(
 
 app.include_router(http_router)
 
+@app.on_event("startup")
+async def startup():
+    # Ladda HA:s entitetsindex och håll det uppdaterat i bakgrunden
+    ha_index.start()
+    # Ping av enheter + nedkoppling av döda anslutningar
+    start_heartbeat()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await stop_heartbeat()
+    await ha_index.stop()
+
 @app.websocket("/ws")
 async def websocket_endpoint(ws: WebSocket):
     await ws_handler(ws)
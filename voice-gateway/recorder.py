@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import wave
+import logging
+import threading
+from datetime import datetime
+from typing import Optional
+
+from config import RECORD_DIR, RECORD_MAX_MB
+
+logger = logging.getLogger(__name__)
+
+# Format på disk (en tur = en inspelning från första chunk till svar):
+#   RECORD_DIR/<YYYYMMDD>/<device_id>-<HHMMSS>-<ms>.wav   rå mic-PCM
+#   RECORD_DIR/<YYYYMMDD>/<device_id>-<HHMMSS>-<ms>.json  metadata:
+#   {
+#     "version": 1,
+#     "device_id": "...", "room": "...", "started_at": "<iso>",
+#     "mic_format": {"sample_rate": 16000, "sample_width": 2, "channels": 1},
+#     "frames": [[ms sedan första chunk, antal bytes], ...],
+#     "stt_text": "...", "action": {...}, "reply": "...",
+#     "timings_ms": {"stt": .., "llm": .., "ha": .., "tts": .., "total": ..},
+#     "error": null
+#   }
+# Lägg till "reference_text" för hand om STT-texten är fel; replay.py
+# använder den i så fall som facit för WER.
+FORMAT_VERSION = 1
+
+# Ungefärlig storlek på RECORD_DIR i bytes; räknas fram vid första sparningen
+# och räknas sedan upp, så att vi bara behöver gå igenom katalogen vid rensning.
+_dir_bytes = None
+# Vid rensning går vi ner till den här andelen av taket, så att det dröjer
+# ett tag innan nästa rensning (och nästa genomgång av katalogen)
+PRUNE_TARGET_RATIO = 0.9
+_limit_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(RECORD_DIR)
+
+
+def start_turn(device_id: str, room: str, sample_rate: int,
+               sample_width: int, channels: int) -> Optional[dict]:
+    """Påbörja inspelning av en tur. Returnerar None om inspelning är avstängd."""
+    if not enabled():
+        return None
+    return {
+        "device_id": device_id or "unknown",
+        "room": room,
+        "started_at": datetime.utcnow(),
+        "t0": time.monotonic(),
+        "mic_format": {
+            "sample_rate": sample_rate,
+            "sample_width": sample_width,
+            "channels": channels,
+        },
+        "frames": [],
+    }
+
+
+def add_frame(rec: Optional[dict], nbytes: int):
+    if rec is None:
+        return
+    rec["frames"].append([round((time.monotonic() - rec["t0"]) * 1000, 1), nbytes])
+
+
+def save(rec: Optional[dict], pcm: bytes, stt_text: Optional[str] = None,
+         action: Optional[dict] = None, reply: Optional[str] = None,
+         timings_ms: Optional[dict] = None, error: Optional[str] = None):
+    """Skriv turen till disk. Blockerande; kör via asyncio.to_thread."""
+    if rec is None:
+        return
+
+    started = rec["started_at"]
+    day_dir = os.path.join(RECORD_DIR, started.strftime("%Y%m%d"))
+    os.makedirs(day_dir, exist_ok=True)
+    safe_id = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in rec["device_id"])
+    base = os.path.join(day_dir, f"{safe_id}-{started.strftime('%H%M%S')}-{started.microsecond // 1000:03d}")
+
+    fmt = rec["mic_format"]
+    with wave.open(base + ".wav", "wb") as w:
+        w.setnchannels(fmt["channels"])
+        w.setsampwidth(fmt["sample_width"])
+        w.setframerate(fmt["sample_rate"])
+        w.writeframes(pcm)
+
+    meta = {
+        "version": FORMAT_VERSION,
+        "device_id": rec["device_id"],
+        "room": rec["room"],
+        "started_at": started.isoformat(),
+        "mic_format": fmt,
+        "frames": rec["frames"],
+        "stt_text": stt_text,
+        "action": action,
+        "reply": reply,
+        "timings_ms": timings_ms or {},
+        "error": error,
+    }
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, separators=(",", ":"))
+
+    logger.debug(f"[{rec['device_id']}] Recorded session to {base}.json")
+    _enforce_limit(os.path.getsize(base + ".wav") + os.path.getsize(base + ".json"))
+
+
+def _corpus_turns():
+    """[(mtime, bas-sökväg, bytes för .wav + .json), ...] för alla turer."""
+    turns = {}
+    for dirpath, _, filenames in os.walk(RECORD_DIR):
+        for fn in filenames:
+            base, ext = os.path.splitext(os.path.join(dirpath, fn))
+            if ext not in (".wav", ".json"):
+                continue
+            try:
+                st = os.stat(base + ext)
+            except OSError:
+                continue
+            mtime, size = turns.get(base, (st.st_mtime, 0))
+            turns[base] = (min(mtime, st.st_mtime), size + st.st_size)
+    return [(mtime, base, size) for base, (mtime, size) in turns.items()]
+
+
+def _enforce_limit(added_bytes: int):
+    """
+    Ta bort äldsta turerna (.wav + .json) när RECORD_DIR överstiger
+    RECORD_MAX_MB, ner till PRUNE_TARGET_RATIO av taket.
+    """
+    global _dir_bytes
+    if RECORD_MAX_MB <= 0:
+        return
+
+    limit = RECORD_MAX_MB * 1024 * 1024
+    # save() körs i trådpoolen, flera turer kan sparas samtidigt
+    with _limit_lock:
+        if _dir_bytes is None:
+            _dir_bytes = sum(size for _, _, size in _corpus_turns())
+        else:
+            _dir_bytes += added_bytes
+        if _dir_bytes <= limit:
+            return
+
+        target = limit * PRUNE_TARGET_RATIO
+        turns = sorted(_corpus_turns())
+        _dir_bytes = sum(size for _, _, size in turns)
+        removed = 0
+        for _, base, size in turns:
+            if _dir_bytes <= target:
+                break
+            for ext in (".json", ".wav"):
+                try:
+                    os.remove(base + ext)
+                except OSError:
+                    pass
+            _dir_bytes -= size
+            removed += 1
+            # Tomma dagskataloger behövs inte
+            day_dir = os.path.dirname(base)
+            if day_dir != RECORD_DIR and not os.listdir(day_dir):
+                os.rmdir(day_dir)
+
+    logger.info(f"Recording limit {RECORD_MAX_MB:.0f} MB reached, removed {removed} old turns")
+
+
+def load(json_path: str):
+    """Läs en inspelad tur. Returnerar (meta, pcm)."""
+    with open(json_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    with wave.open(os.path.splitext(json_path)[0] + ".wav", "rb") as w:
+        pcm = w.readframes(w.getnframes())
+    return meta, pcm
+
+
+def iter_corpus(root: str):
+    """Alla inspelade turer under root, sorterade på sökväg (= tid per dag)."""
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        names = set(filenames)
+        # Hoppa över turer som bara delvis finns kvar (t.ex. mitt i en rensning)
+        paths.extend(
+            os.path.join(dirpath, fn) for fn in filenames
+            if fn.endswith(".json") and fn[:-5] + ".wav" in names
+        )
+    for path in sorted(paths):
+        yield path
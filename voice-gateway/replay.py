@@ -0,0 +1,210 @@
+"""
+Offline-replay av inspelade sessioner (RECORD_DIR, se recorder.py).
+
+Kör varje inspelad tur genom nuvarande STT -> brain -> TTS och jämför mot
+det som hände i produktion:
+- WER för STT-texten (mot "reference_text" om den finns, annars mot den
+  inspelade STT-texten)
+- tid för STT, TTS och STT+TTS, inspelat vs nu
+
+LiteLLM och Home Assistant är stubbade: LLM:en "svarar" med den inspelade
+action:en och HA-anrop går ingenstans. "llm", "ha" och pipelinens totaltid
+är därför inte jämförbara med produktion och ingår inte i jämförelsen;
+STT och TTS körs på riktigt.
+
+Användning:
+  python replay.py /data/recordings
+  python replay.py /data/recordings --realtime --limit 50
+"""
+import re
+import sys
+import json
+import time
+import types
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+import brain
+import recorder
+from config import LITELLM_URL
+from stt import transcribe_wav
+from tts import synthesize_chunks
+from utils import pcm_to_wav
+
+# Steg som körs på riktigt i replay och därför kan jämföras mot inspelningen.
+# llm/ha är stubbade och total innehåller dem, så de jämförs inte.
+STAGES = ["stt", "tts", "stt+tts"]
+
+
+def _compared_timings(timings_ms: dict) -> dict:
+    compared = {stage: timings_ms[stage] for stage in ("stt", "tts") if stage in timings_ms}
+    if len(compared) == 2:
+        compared["stt+tts"] = compared["stt"] + compared["tts"]
+    return compared
+
+
+def _words(text: str):
+    return re.sub(r"[^\w\s]", " ", (text or "").lower()).split()
+
+
+def word_errors(reference: str, hypothesis: str):
+    """Levenshtein på ordnivå. Returnerar (antal fel, antal ord i facit)."""
+    ref, hyp = _words(reference), _words(hypothesis)
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, start=1):
+        cur = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, start=1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1], len(ref)
+
+
+def _stub_http(recorded_action):
+    """Byt ut brains httpx mot en som svarar med den inspelade action:en."""
+    def handler(request: httpx.Request) -> httpx.Response:
+        if str(request.url) == LITELLM_URL:
+            action = recorded_action or {"action": "say", "reply": "Okej."}
+            content = json.dumps(action, ensure_ascii=False)
+            return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+        return httpx.Response(200, json=[])
+
+    brain.httpx = types.SimpleNamespace(
+        AsyncClient=lambda **kw: httpx.AsyncClient(transport=httpx.MockTransport(handler), **kw)
+    )
+
+
+async def _pace(frames):
+    # Spela upp mic-uppladdningen i samma takt som den spelades in
+    start = time.monotonic()
+    for offset_ms, _ in frames:
+        delay = offset_ms / 1000 - (time.monotonic() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def replay_turn(meta: dict, pcm: bytes, realtime: bool) -> dict:
+    timings = {}
+
+    def mark(stage: str, t0: float):
+        timings[stage] = round((time.perf_counter() - t0) * 1000, 1)
+
+    if realtime:
+        await _pace(meta.get("frames", []))
+
+    fmt = meta["mic_format"]
+    wav_bytes = pcm_to_wav(
+        pcm,
+        sample_rate=fmt["sample_rate"],
+        sample_width=fmt["sample_width"],
+        channels=fmt["channels"],
+    )
+
+    _stub_http(meta.get("action"))
+
+    t0 = time.perf_counter()
+    user_text = await asyncio.to_thread(transcribe_wav, wav_bytes)
+    mark("stt", t0)
+
+    if user_text.strip():
+        t0 = time.perf_counter()
+        action_obj = await brain.ask_llm(user_text, meta.get("room", "unknown"))
+        mark("llm", t0)
+        t0 = time.perf_counter()
+        await brain.call_home_assistant_if_needed(action_obj, meta.get("room", "unknown"))
+        mark("ha", t0)
+        reply_text = action_obj.get("reply", "Okej.")
+    else:
+        reply_text = "Jag hörde inte vad du sa."
+
+    t0 = time.perf_counter()
+    await synthesize_chunks(reply_text)
+    mark("tts", t0)
+
+    return {"stt_text": user_text, "timings_ms": timings}
+
+
+def _fmt_ms(value):
+    return "-" if value is None else f"{value:.0f}"
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded voice sessions offline")
+    parser.add_argument("corpus", help="Katalog med inspelningar (RECORD_DIR)")
+    parser.add_argument("--realtime", action="store_true",
+                        help="Spela upp mic-ljudet i inspelad takt i stället för full fart")
+    parser.add_argument("--limit", type=int, default=0, help="Max antal turer (0 = alla)")
+    args = parser.parse_args(argv)
+
+    # Svarscachen skulle dölja skillnader mellan turer
+    brain.LLM_CACHE_TTL_SEC = 0
+
+    total_errors = 0
+    total_words = 0
+    stage_values = {stage: ([], []) for stage in STAGES}  # (inspelat, nu)
+    count = 0
+
+    for path in recorder.iter_corpus(args.corpus):
+        if args.limit and count >= args.limit:
+            break
+
+        meta, pcm = recorder.load(path)
+        if not pcm:
+            # T.ex. no_audio: inget att köra genom STT
+            print(f"{path}: skipped, no audio (recorded error: {meta.get('error')})")
+            continue
+
+        result = await replay_turn(meta, pcm, args.realtime)
+        count += 1
+
+        # Utan facit (tom STT-text i produktion) finns inget att räkna WER mot
+        reference = meta.get("reference_text") or meta.get("stt_text") or ""
+        errors, n_words = word_errors(reference, result["stt_text"])
+        if n_words:
+            total_errors += errors
+            total_words += n_words
+
+        recorded = _compared_timings(meta.get("timings_ms") or {})
+        replayed = _compared_timings(result["timings_ms"])
+        deltas = []
+        for stage in STAGES:
+            before = recorded.get(stage)
+            after = replayed.get(stage)
+            if before is not None and after is not None:
+                stage_values[stage][0].append(before)
+                stage_values[stage][1].append(after)
+                deltas.append(f"{stage} {after - before:+.0f}")
+        deltas.append("llm/ha stubbed (n/a)")
+        if meta.get("error"):
+            deltas.append(f"recorded error: {meta['error']}")
+
+        wer = f"{errors / n_words:.2f}" if n_words else "n/a"
+        print(f"{path}: WER {wer}  {'  '.join(deltas)}")
+        if errors and n_words:
+            print(f"    ref: {reference}")
+            print(f"    hyp: {result['stt_text']}")
+
+    if not count:
+        print(f"No recordings found in {args.corpus}")
+        return 1
+
+    print()
+    print(f"Turns: {count}")
+    print(f"WER:   {total_errors / total_words if total_words else 0.0:.3f} ({total_errors}/{total_words} words)")
+    print(f"{'stage':<8} {'recorded':>9} {'replay':>9} {'delta':>9} {'replay p95':>11}  (ms, mean; llm/ha stubbed, not compared)")
+    for stage in STAGES:
+        before, after = stage_values[stage]
+        if not after:
+            continue
+        p95 = statistics.quantiles(after, n=20)[-1] if len(after) > 1 else after[0]
+        mean_before = statistics.mean(before)
+        mean_after = statistics.mean(after)
+        print(f"{stage:<8} {_fmt_ms(mean_before):>9} {_fmt_ms(mean_after):>9} "
+              f"{mean_after - mean_before:>+9.0f} {_fmt_ms(p95):>11}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -5,15 +5,38 @@ from typing import Dict, Any, List
 from stt import transcribe_wav
 from tts import synthesize_chunks, build_wav
 from brain import ask_llm, call_home_assistant_if_needed
+import websocket_handler
 from websocket_handler import clients, broadcast_tts
+import ha_index
+from datetime import datetime
 
 router = APIRouter()
 
 @router.get("/health")
 async def health():
+    now = datetime.utcnow()
+    devices = {
+        cid: {
+            "room": c["room"],
+            "connected_sec": round((now - c["connected_at"]).total_seconds(), 1),
+            "last_seen_sec": round((now - c["last_seen"]).total_seconds(), 1),
+            "heartbeat": c["heartbeat"],
+            "rtt_ms": c["rtt_ms"],
+            "busy": c["busy"],
+        }
+        for cid, c in clients.items()
+    }
     return {
         "ok": True,
         "connected_clients": list(clients.keys()),
+        "devices": devices,
+        "connections": websocket_handler.connection_count,
+        "active_recordings": websocket_handler.active_recordings,
+        "ha_index": {
+            "loaded": ha_index.loaded,
+            "entities": len(ha_index.entities),
+            "areas": len(ha_index.areas),
+        },
     }
 
 @router.post("/pipeline-http")
@@ -29,7 +52,7 @@ async def pipeline_http(room: str = Form(...), audio: UploadFile = File(...)):
 
     # 2. Brain/LLM + HA
     action = await ask_llm(user_text, room)
-    await call_home_assistant_if_needed(action)
+    await call_home_assistant_if_needed(action, room)
     reply = action.get("reply", "Okej.")
 
     # 3. TTS
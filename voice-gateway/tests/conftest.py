@@ -0,0 +1,21 @@
+import os
+import sys
+import types
+
+# Gatewayens moduler importeras platt (som i Dockerfile: WORKDIR /app)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Lokala ersättare för Whisper/Piper (stt.py/tts.py laddar modellerna vid
+# import) så att websocket_handler och replay kan testas utan modeller.
+_stt = types.ModuleType("stt")
+_stt.transcribe_wav = lambda wav_bytes: ""
+sys.modules.setdefault("stt", _stt)
+
+
+async def _synthesize_chunks(text):
+    return {"sample_rate": 16000, "sample_width": 2, "channels": 1}, [b"\x00\x00" * 8]
+
+_tts = types.ModuleType("tts")
+_tts.synthesize_chunks = _synthesize_chunks
+_tts.build_wav = lambda chunks, meta: b""
+sys.modules.setdefault("tts", _tts)
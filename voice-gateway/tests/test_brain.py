@@ -0,0 +1,61 @@
+import pytest
+
+import brain
+import ha_index
+
+
+@pytest.fixture(autouse=True)
+def caches(monkeypatch):
+    monkeypatch.setattr(brain, "LLM_CACHE_TTL_SEC", 60)
+    monkeypatch.setattr(brain, "LLM_CACHE_MAX_ENTRIES", 2)
+    brain._room_prompts.clear()
+    brain._response_cache.clear()
+    yield
+    brain._room_prompts.clear()
+    brain._response_cache.clear()
+
+
+def test_prompt_starts_with_shared_static_prefix():
+    kok = brain.build_system_prompt("kök")
+    hall = brain.build_system_prompt("hall")
+    assert kok.startswith(brain.STATIC_PROMPT)
+    assert hall.startswith(brain.STATIC_PROMPT)
+    assert kok.endswith('"kök".')
+
+
+def test_room_prompt_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(brain, "ROOM_PROMPT_CACHE_MAX", 3)
+    for i in range(10):
+        brain.build_system_prompt(f"rum{i}")
+    assert list(brain._room_prompts) == ["rum7", "rum8", "rum9"]
+
+
+def test_cache_keeps_only_say_actions():
+    key = ("tänd lampan", "kök", ha_index.index_version)
+    brain._cache_put(key, {"action": "homeassistant.call_service", "reply": "Okej"})
+    assert brain._cache_get(key) is None
+
+    key = ("vad är klockan", "kök", ha_index.index_version)
+    brain._cache_put(key, {"action": "say", "reply": "Tolv"})
+    assert brain._cache_get(key) == {"action": "say", "reply": "Tolv"}
+
+
+def test_cache_evicts_least_recently_used():
+    version = ha_index.index_version
+    brain._cache_get(("x", "kök", version))  # synka cache-versionen
+    for text in ("a", "b", "c"):
+        brain._cache_put((text, "kök", version), {"action": "say", "reply": text})
+    assert brain._cache_get(("a", "kök", version)) is None
+    assert brain._cache_get(("c", "kök", version)) is not None
+
+
+def test_cache_cleared_when_entity_index_changes(monkeypatch):
+    version = ha_index.index_version
+    key = ("finns det en lampa", "kök", version)
+    brain._cache_get(key)
+    brain._cache_put(key, {"action": "say", "reply": "Nej"})
+    assert brain._cache_get(key) is not None
+
+    monkeypatch.setattr(ha_index, "index_version", version + 1)
+    assert brain._cache_get(key) is None
+    assert not brain._response_cache
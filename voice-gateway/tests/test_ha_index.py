@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+
+import brain
+import ha_index
+
+# Lokal ersättare för svaren från HA:s websocket-API
+STATES = [
+    {"entity_id": "light.kok_tak", "state": "on", "attributes": {"friendly_name": "Taklampa kök"}},
+    {"entity_id": "light.vardagsrum_golv", "state": "off", "attributes": {"friendly_name": "Golvlampa"}},
+    {"entity_id": "switch.kok_child_lock", "state": "off", "attributes": {"friendly_name": "Barnlås"}},
+    {"entity_id": "light.gammal", "state": "off", "attributes": {"friendly_name": "Gammal lampa"}},
+    {"entity_id": "sensor.temperatur", "state": "21.5", "attributes": {}},
+]
+AREAS = [
+    {"area_id": "kok", "name": "Kök"},
+    {"area_id": "vardagsrum", "name": "Vardagsrum"},
+]
+ENTITY_REGISTRY = [
+    {"entity_id": "light.kok_tak", "area_id": "kok"},
+    {"entity_id": "light.vardagsrum_golv", "device_id": "dev1"},
+    {"entity_id": "switch.kok_child_lock", "area_id": "kok", "entity_category": "config"},
+    {"entity_id": "light.gammal", "area_id": "kok", "disabled_by": "user"},
+]
+DEVICE_REGISTRY = [
+    {"id": "dev1", "area_id": "vardagsrum"},
+]
+
+
+@pytest.fixture(autouse=True)
+def index():
+    ha_index.build_index(STATES, AREAS, ENTITY_REGISTRY, DEVICE_REGISTRY)
+    yield
+    ha_index.entities.clear()
+    ha_index.areas.clear()
+    ha_index._excluded.clear()
+    ha_index.loaded = False
+
+
+def test_build_index_filters_untracked_and_hidden_entities():
+    assert set(ha_index.entities) == {"light.kok_tak", "light.vardagsrum_golv"}
+
+
+def test_area_comes_from_entity_or_device_registry():
+    assert ha_index.entities["light.kok_tak"]["area_id"] == "kok"
+    assert ha_index.entities["light.vardagsrum_golv"]["area_id"] == "vardagsrum"
+
+
+def test_room_matches_area_id_or_name():
+    assert ha_index.room_area_id("kok") == "kok"
+    assert ha_index.room_area_id("Kök") == "kok"
+    assert ha_index.room_area_id("hall") is None
+
+
+def test_prompt_lists_room_entities():
+    prompt = ha_index.format_entities_for_prompt("Kök")
+    assert "light.kok_tak: Taklampa kök" in prompt
+    assert "light.vardagsrum_golv" not in prompt
+
+
+def test_prompt_groups_by_area_for_unknown_room():
+    prompt = ha_index.format_entities_for_prompt("hall")
+    assert "Kök:\n- light.kok_tak" in prompt
+    assert "Vardagsrum:\n- light.vardagsrum_golv" in prompt
+
+
+def test_resolve_keeps_known_entity_id():
+    assert ha_index.resolve_entity_id("light.kok_tak", "light", "kok") == "light.kok_tak"
+
+
+def test_resolve_corrects_close_guess():
+    assert ha_index.resolve_entity_id("light.kok_taklampa", "light", "kok") == "light.kok_tak"
+    assert ha_index.resolve_entity_id("light.golvlampa", "light", "hall") == "light.vardagsrum_golv"
+
+
+def test_resolve_rejects_unknown_entity():
+    assert ha_index.resolve_entity_id("light.sovrum", "light", "kok") is None
+
+
+def test_resolve_passes_through_untracked_domain():
+    assert ha_index.resolve_entity_id("input_boolean.gastlage", "input_boolean", "kok") == "input_boolean.gastlage"
+    assert ha_index.resolve_entity_id("gastlage", "input_boolean", "kok") == "gastlage"
+
+
+def test_call_home_assistant_keeps_untracked_entity(monkeypatch):
+    posted = []
+
+    class Client:
+        def __init__(self, **kwargs):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def post(self, url, json, headers):
+            posted.append((url, json))
+
+    monkeypatch.setattr(brain.httpx, "AsyncClient", Client)
+    action = {
+        "action": "homeassistant.call_service",
+        "domain": "input_boolean",
+        "service": "turn_on",
+        "entity_id": "input_boolean.gastlage",
+        "reply": "Gästläget är på.",
+    }
+    asyncio.run(brain.call_home_assistant_if_needed(action, "kok"))
+    assert posted == [(f"{brain.HA_URL}/api/services/input_boolean/turn_on",
+                       {"entity_id": "input_boolean.gastlage"})]
+    assert action["reply"] == "Gästläget är på."
+
+
+def test_state_change_updates_state_without_bumping_version():
+    version = ha_index.index_version
+    ha_index.apply_state_change({
+        "entity_id": "light.kok_tak",
+        "new_state": {"state": "off", "attributes": {"friendly_name": "Taklampa kök"}},
+    })
+    assert ha_index.entities["light.kok_tak"]["state"] == "off"
+    assert ha_index.index_version == version
+
+
+def test_state_change_ignores_filtered_entities():
+    version = ha_index.index_version
+    for eid in ("switch.kok_child_lock", "light.gammal"):
+        ha_index.apply_state_change({
+            "entity_id": eid,
+            "new_state": {"state": "on", "attributes": {"friendly_name": "x"}},
+        })
+    assert "switch.kok_child_lock" not in ha_index.entities
+    assert "light.gammal" not in ha_index.entities
+    assert ha_index.index_version == version
+
+
+def test_state_change_removes_deleted_entity():
+    ha_index.apply_state_change({"entity_id": "light.kok_tak", "new_state": None})
+    assert "light.kok_tak" not in ha_index.entities
+
+
+def test_call_home_assistant_rejects_unknown_entity():
+    action = {
+        "action": "homeassistant.call_service",
+        "domain": "light",
+        "service": "turn_on",
+        "entity_id": "light.sovrum",
+        "reply": "Tänder i sovrummet.",
+    }
+    # Inget HA-anrop ska ske; httpx pekar mot en host som inte finns
+    asyncio.run(brain.call_home_assistant_if_needed(action, "kok"))
+    assert action["reply"] == "Jag hittar ingen sådan enhet."
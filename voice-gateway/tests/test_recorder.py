@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+import recorder
+
+
+@pytest.fixture(autouse=True)
+def record_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(recorder, "RECORD_DIR", str(tmp_path))
+    monkeypatch.setattr(recorder, "RECORD_MAX_MB", 0)
+    monkeypatch.setattr(recorder, "_dir_bytes", None)
+    return tmp_path
+
+
+def _record(device_id="esp1", pcm=b"\x01\x00" * 1600, **kwargs):
+    rec = recorder.start_turn(device_id, "kök", 16000, 2, 1)
+    recorder.add_frame(rec, len(pcm))
+    recorder.save(rec, pcm, **kwargs)
+
+
+def test_disabled_without_record_dir(monkeypatch):
+    monkeypatch.setattr(recorder, "RECORD_DIR", "")
+    assert recorder.start_turn("esp1", "kök", 16000, 2, 1) is None
+
+
+def test_save_and_load_round_trip():
+    pcm = b"\x01\x00" * 1600
+    _record(pcm=pcm, stt_text="vad är klockan", action={"action": "say", "reply": "Tolv"},
+            reply="Tolv", timings_ms={"stt": 120.0, "tts": 80.0})
+
+    paths = list(recorder.iter_corpus(recorder.RECORD_DIR))
+    assert len(paths) == 1
+    meta, loaded = recorder.load(paths[0])
+    assert loaded == pcm
+    assert meta["room"] == "kök"
+    assert meta["mic_format"] == {"sample_rate": 16000, "sample_width": 2, "channels": 1}
+    assert meta["frames"][0][1] == len(pcm)
+    assert meta["stt_text"] == "vad är klockan"
+    assert meta["error"] is None
+
+
+def test_error_turn_is_saved():
+    _record(pcm=b"", error="no_audio")
+    meta, pcm = recorder.load(next(recorder.iter_corpus(recorder.RECORD_DIR)))
+    assert meta["error"] == "no_audio"
+    assert pcm == b""
+
+
+def test_size_limit_removes_oldest_turns(monkeypatch):
+    # Varje tur är ~32 kB; taket rymmer ungefär två
+    monkeypatch.setattr(recorder, "RECORD_MAX_MB", 0.07)
+    for i in range(5):
+        _record(device_id=f"esp{i}", pcm=b"\x01\x00" * 16000)
+        # Olika mtime så att "äldst" är entydigt
+        for path in recorder.iter_corpus(recorder.RECORD_DIR):
+            if os.path.basename(path).startswith(f"esp{i}-"):
+                os.utime(path, (i, i))
+                os.utime(path[:-5] + ".wav", (i, i))
+
+    remaining = sorted(os.path.basename(p).split("-")[0] for p in recorder.iter_corpus(recorder.RECORD_DIR))
+    assert remaining == ["esp3", "esp4"]
+    # Inga halva turer kvar
+    files = [fn for _, _, fns in os.walk(recorder.RECORD_DIR) for fn in fns]
+    assert len(files) == 2 * len(remaining)
+
+
+def test_prune_goes_below_limit_so_next_save_does_not_walk(monkeypatch):
+    monkeypatch.setattr(recorder, "RECORD_MAX_MB", 0.1)
+    for i in range(4):
+        _record(device_id=f"esp{i}", pcm=b"\x01\x00" * 16000)
+    assert recorder._dir_bytes <= 0.1 * 1024 * 1024 * recorder.PRUNE_TARGET_RATIO
+
+    walks = []
+    real = recorder._corpus_turns
+    monkeypatch.setattr(recorder, "_corpus_turns", lambda: walks.append(1) or real())
+    _record(device_id="esp9", pcm=b"\x01\x00" * 100)
+    assert not walks
@@ -0,0 +1,33 @@
+import pytest
+
+import replay
+
+
+@pytest.mark.parametrize("reference, hypothesis, expected", [
+    ("tänd lampan i köket", "tänd lampan i köket", (0, 4)),
+    ("tänd lampan i köket", "släck lampan i köket", (1, 4)),   # substitution
+    ("tänd lampan", "tänd lampan i köket", (2, 2)),            # insättning
+    ("tänd lampan i köket", "tänd köket", (2, 4)),             # borttagning
+    ("Vad är klockan?", "vad är klockan", (0, 3)),             # skiftläge/skiljetecken
+    ("", "vad är klockan", (3, 0)),                            # tomt facit
+    ("", "", (0, 0)),
+])
+def test_word_errors(reference, hypothesis, expected):
+    assert replay.word_errors(reference, hypothesis) == expected
+
+
+def test_compared_timings_sums_stt_and_tts():
+    timings = {"stt": 120.0, "llm": 900.0, "ha": 30.0, "tts": 80.0, "total": 1130.0}
+    assert replay._compared_timings(timings) == {"stt": 120.0, "tts": 80.0, "stt+tts": 200.0}
+
+
+@pytest.mark.parametrize("timings", [
+    {"stt": 120.0},
+    {"tts": 80.0},
+    {"llm": 900.0, "total": 900.0},
+    {},
+])
+def test_compared_timings_needs_both_stages_for_sum(timings):
+    compared = replay._compared_timings(timings)
+    assert "stt+tts" not in compared
+    assert set(compared) <= {"stt", "tts"}
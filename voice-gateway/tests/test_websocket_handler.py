@@ -0,0 +1,218 @@
+import time
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import FastAPI, WebSocket
+from fastapi.testclient import TestClient
+from fastapi.websockets import WebSocketState
+
+import websocket_handler as wh
+
+app = FastAPI()
+
+
+@app.websocket("/ws")
+async def websocket_endpoint(ws: WebSocket):
+    await wh.ws_handler(ws)
+
+
+async def _synthesize_chunks(text):
+    return {"sample_rate": 16000, "sample_width": 2, "channels": 1}, [b"\x00\x00" * 8]
+
+
+@pytest.fixture(autouse=True)
+def handler_state(monkeypatch):
+    monkeypatch.setattr(wh, "transcribe_wav", lambda wav_bytes: "")
+    monkeypatch.setattr(wh, "synthesize_chunks", _synthesize_chunks)
+    wh.clients.clear()
+    wh.connection_count = 0
+    wh.active_recordings = 0
+    yield
+    wh.clients.clear()
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as c:
+        yield c
+
+
+def _hello(ws, device_id, **extra):
+    ws.send_json({"type": "hello", "device_id": device_id, "room": "kok", **extra})
+    assert ws.receive_json()["type"] == "hello_ack"
+
+
+def test_rejects_connections_over_limit(client, monkeypatch):
+    monkeypatch.setattr(wh, "WS_MAX_CONNECTIONS", 1)
+    with client.websocket_connect("/ws") as first:
+        _hello(first, "a")
+        with client.websocket_connect("/ws") as second:
+            assert second.receive_json()["error"] == "server_full"
+        assert wh.connection_count == 1
+    assert wh.connection_count == 0
+    assert not wh.clients
+
+
+def test_rejects_recordings_over_limit_and_releases_slot(client, monkeypatch):
+    monkeypatch.setattr(wh, "WS_MAX_ACTIVE_RECORDINGS", 1)
+    with client.websocket_connect("/ws") as a, client.websocket_connect("/ws") as b:
+        _hello(a, "a")
+        _hello(b, "b")
+
+        a.send_bytes(b"\x00\x00" * 1600)
+        b.send_bytes(b"\x00\x00" * 1600)
+        assert b.receive_json()["error"] == "server_busy"
+        assert wh.active_recordings == 1
+
+        a.send_json({"type": "end_recording"})
+        assert a.receive_json()["type"] == "assistant_reply"
+        a.receive_bytes()
+        assert a.receive_json()["type"] == "assistant_end"
+        assert wh.active_recordings == 0
+
+
+def test_rejected_recording_gets_no_second_error(client, monkeypatch):
+    monkeypatch.setattr(wh, "MAX_AUDIO_BYTES", 100)
+    with client.websocket_connect("/ws") as ws:
+        _hello(ws, "a")
+        ws.send_bytes(b"\x00" * 200)
+        assert ws.receive_json()["error"] == "recording_too_large"
+
+        # end_recording för den avvisade turen ska inte ge no_audio
+        ws.send_json({"type": "end_recording"})
+        ws.send_json({"type": "ping", "ts": 3})
+        assert ws.receive_json() == {"type": "pong", "ts": 3}
+
+        # Nästa tur fungerar som vanligt
+        ws.send_json({"type": "end_recording"})
+        assert ws.receive_json()["error"] == "no_audio"
+
+
+def test_pong_measures_rtt(client):
+    with client.websocket_connect("/ws") as ws:
+        _hello(ws, "a", heartbeat=True)
+        wh.clients["a"]["ping_sent"] = time.monotonic() - 0.05
+
+        ws.send_json({"type": "pong"})
+        # ping -> pong som synkpunkt: då har pongen ovan hanterats
+        ws.send_json({"type": "ping", "ts": 1})
+        assert ws.receive_json() == {"type": "pong", "ts": 1}
+
+        assert wh.clients["a"]["rtt_ms"] >= 50
+        assert wh.clients["a"]["ping_sent"] is None
+
+
+def test_hello_timeout_closes_silent_socket(client, monkeypatch):
+    monkeypatch.setattr(wh, "WS_HELLO_TIMEOUT_SEC", 0.1)
+    with client.websocket_connect("/ws") as ws:
+        with pytest.raises(Exception):
+            ws.receive_json()
+    assert wh.connection_count == 0
+
+
+class FakeWS:
+    def __init__(self, hang=False):
+        self.hang = hang
+        self.sent = []
+        self.closed = False
+        self.client_state = WebSocketState.CONNECTED
+
+    async def send_json(self, data):
+        if self.hang:
+            await asyncio.sleep(3600)
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        if self.hang:
+            await asyncio.sleep(3600)
+        self.closed = True
+
+
+def _client(ws, **overrides):
+    entry = {
+        "ws": ws,
+        "room": "kok",
+        "connected_at": datetime.utcnow(),
+        "last_seen": datetime.utcnow(),
+        "busy": False,
+        "broadcasting": False,
+        "heartbeat": True,
+        "ping_sent": None,
+        "rtt_ms": None,
+    }
+    entry.update(overrides)
+    return entry
+
+
+def test_heartbeat_reaps_idle_client(monkeypatch):
+    monkeypatch.setattr(wh, "WS_IDLE_TIMEOUT_SEC", 30)
+    ws = FakeWS()
+    wh.clients["a"] = _client(ws, last_seen=datetime.utcnow() - timedelta(seconds=60))
+
+    asyncio.run(wh._heartbeat_client("a", wh.clients["a"], datetime.utcnow()))
+
+    assert "a" not in wh.clients
+    assert ws.closed
+
+
+def test_heartbeat_reaps_client_whose_ping_hangs(monkeypatch):
+    monkeypatch.setattr(wh, "HEARTBEAT_SEND_TIMEOUT_SEC", 0.05)
+    wh.clients["a"] = _client(FakeWS(hang=True))
+
+    asyncio.run(wh._heartbeat_client("a", wh.clients["a"], datetime.utcnow()))
+
+    assert "a" not in wh.clients
+
+
+def test_heartbeat_loop_skips_busy_and_broadcasting_clients(monkeypatch):
+    monkeypatch.setattr(wh, "WS_PING_INTERVAL_SEC", 0.01)
+    idle, busy, broadcasting, legacy = FakeWS(), FakeWS(), FakeWS(), FakeWS()
+    wh.clients.update({
+        "idle": _client(idle),
+        "busy": _client(busy, busy=True),
+        "broadcasting": _client(broadcasting, broadcasting=True),
+        "legacy": _client(legacy, heartbeat=False),
+    })
+
+    async def run():
+        task = asyncio.create_task(wh.heartbeat_loop())
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(run())
+
+    assert {"type": "ping"} in idle.sent
+    assert not busy.sent
+    assert not broadcasting.sent
+    assert not legacy.sent
+
+
+def test_rehello_replaces_previous_connection(client):
+    with client.websocket_connect("/ws") as old, client.websocket_connect("/ws") as new:
+        _hello(old, "a")
+        _hello(new, "a")
+        # Den gamla socketen stängs i bakgrunden, den nya lever vidare
+        with pytest.raises(Exception):
+            old.receive_json()
+        new.send_json({"type": "ping", "ts": 2})
+        assert new.receive_json() == {"type": "pong", "ts": 2}
+        assert "a" in wh.clients
+
+
+def test_broadcast_marks_client_broadcasting():
+    seen = []
+
+    class RecordingWS(FakeWS):
+        async def send_json(self, data):
+            seen.append(wh.clients["a"]["broadcasting"])
+            await super().send_json(data)
+
+        async def send_bytes(self, data):
+            seen.append(wh.clients["a"]["broadcasting"])
+
+    wh.clients["a"] = _client(RecordingWS())
+    asyncio.run(wh.broadcast_tts(["a"], "Maten är klar!"))
+
+    assert seen and all(seen)
+    assert wh.clients["a"]["broadcasting"] is False
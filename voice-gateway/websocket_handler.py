@@ -1,4 +1,5 @@
 import json
+import time
 import uuid
 import asyncio
 import logging
@@ -12,15 +13,36 @@ logger = logging.getLogger(__name__)
 from tts import synthesize_chunks
 from brain import ask_llm, call_home_assistant_if_needed
 from utils import pcm_to_wav
+import recorder
+from config import (
+    WS_MAX_CONNECTIONS, WS_MAX_ACTIVE_RECORDINGS,
+    WS_PING_INTERVAL_SEC, WS_IDLE_TIMEOUT_SEC, WS_HELLO_TIMEOUT_SEC,
+)
 
 # Alla aktiva enheter
 # clients[device_id] = {
 #   "ws": WebSocket,
 #   "room": "vardagsrum",
-#   "last_seen": datetime.utcnow(),
+#   "connected_at": datetime.utcnow(),
+#   "last_seen": datetime.utcnow(),    # uppdateras vid varje meddelande
+#   "busy": False,                     # True medan pipeline/svar pågår
+#   "broadcasting": False,             # True medan /announce skickas
+#   "heartbeat": False,                # enheten svarar på {"type":"ping"}
+#   "ping_sent": None,                 # time.monotonic() för senaste ping
+#   "rtt_ms": None,                    # senaste uppmätta ping -> pong
 # }
 clients = {}
 
+# Öppna sockets (även de som inte skickat "hello" än) och pågående inspelningar
+connection_count = 0
+active_recordings = 0
+
+_heartbeat_task = None
+HEARTBEAT_SEND_TIMEOUT_SEC = 5  # max tid för ping/close mot en enskild enhet
+
+# Referenser till fristående close-tasks så att de inte skräpsamlas i förtid
+_background_tasks = set()
+
 # Audio limits
 MAX_AUDIO_BYTES = 10 * 1024 * 1024  # 10 MB max recording
 MAX_AUDIO_DURATION_SEC = 60  # 60 seconds max
@@ -33,9 +55,30 @@ async def ws_handler(ws: WebSocket):
     - "hello": registrera device_id, room, mic format
     - binära frames: rå PCM16LE från mic
     - "end_recording": vi kör STT -> brain -> HA -> TTS och streamar tillbaka
+    - "ping"/"pong": heartbeat (valfritt för firmware)
+
+    Heartbeat: firmware som skickar "heartbeat": true i "hello" (eller själv
+    skickar ping/pong) får {"type":"ping"} var WS_PING_INTERVAL_SEC och MÅSTE
+    svara {"type":"pong"}. Bara sådana enheter får RTT-mätning och kopplas
+    ner efter WS_IDLE_TIMEOUT_SEC utan trafik. Äldre firmware pingas inte
+    alls; där sköter uvicorns ping/pong på protokollnivå döda anslutningar.
     """
+    global connection_count, active_recordings
+
     await ws.accept()
-    logger.info("New WebSocket connection accepted")
+
+    if connection_count >= WS_MAX_CONNECTIONS:
+        logger.warning(f"Rejecting connection, {connection_count} connections open")
+        await ws.send_json({
+            "type": "error",
+            "error": "server_full",
+            "message": f"Server has reached {WS_MAX_CONNECTIONS} connections",
+        })
+        await ws.close(code=1013)
+        return
+
+    connection_count += 1
+    logger.info(f"New WebSocket connection accepted ({connection_count} open)")
 
     device_id = None
     room = "unknown"
@@ -48,16 +91,83 @@ async def ws_handler(ws: WebSocket):
     recorded_chunks = []
     recorded_bytes_total = 0
     recording_done = False
+    recording_slot = False
+    recording_rejected = False  # turen avvisad (server_busy/too_large), felet redan skickat
+    session_rec = None  # recorder-tur, bara när RECORD_DIR är satt
+
+    def reset_recording():
+        # Nollställ inspelningen och släpp ev. plats bland pågående inspelningar
+        nonlocal recorded_bytes_total, recording_done, recording_slot, recording_rejected, session_rec
+        global active_recordings
+        recorded_chunks.clear()
+        recorded_bytes_total = 0
+        recording_done = False
+        recording_rejected = False
+        session_rec = None
+        if recording_slot:
+            active_recordings -= 1
+            recording_slot = False
+
+    async def save_session(pcm: bytes, turn: dict, error=None):
+        # Spara turen för offline-replay; får aldrig störa själva svaret
+        if session_rec is None:
+            return
+        try:
+            await asyncio.to_thread(
+                recorder.save, session_rec, pcm,
+                stt_text=turn.get("stt_text"),
+                action=turn.get("action"),
+                reply=turn.get("reply"),
+                timings_ms=turn["timings_ms"],
+                error=error,
+            )
+        except Exception as e:
+            logger.warning(f"[{device_id}] Failed to record session: {e}")
+
+    def set_busy(busy: bool):
+        if device_id in clients and clients[device_id]["ws"] is ws:
+            clients[device_id]["busy"] = busy
+            clients[device_id]["last_seen"] = datetime.utcnow()
 
     try:
         while True:
-            msg = await ws.receive()
+            # Innan "hello" finns enheten inte i clients och syns inte för
+            # reapern, men räknas mot WS_MAX_CONNECTIONS. Därför en egen gräns
+            # oberoende av (opt-in) idle-reapern.
+            if device_id is None and WS_HELLO_TIMEOUT_SEC > 0:
+                try:
+                    msg = await asyncio.wait_for(ws.receive(), timeout=WS_HELLO_TIMEOUT_SEC)
+                except asyncio.TimeoutError:
+                    logger.warning(f"No hello within {WS_HELLO_TIMEOUT_SEC}s, closing")
+                    break
+            else:
+                msg = await ws.receive()
+
+            if device_id in clients and clients[device_id]["ws"] is ws:
+                clients[device_id]["last_seen"] = datetime.utcnow()
 
             # Binärt = mic audio chunk
             if msg.get("bytes") is not None:
                 chunk = msg["bytes"]
                 logger.debug(f"[{device_id or 'unknown'}] Received binary chunk: {len(chunk)} bytes")
                 if not recording_done:
+                    # Första chunken: ta en plats bland pågående inspelningar
+                    if not recording_slot:
+                        if active_recordings >= WS_MAX_ACTIVE_RECORDINGS:
+                            logger.warning(f"[{device_id}] Too many active recordings, rejecting")
+                            await ws.send_json({
+                                "type": "error",
+                                "error": "server_busy",
+                                "message": f"Server is handling {WS_MAX_ACTIVE_RECORDINGS} recordings",
+                            })
+                            reset_recording()
+                            recording_done = True
+                            recording_rejected = True
+                            continue
+                        active_recordings += 1
+                        recording_slot = True
+                        session_rec = recorder.start_turn(device_id, room, mic_sr, mic_width, mic_ch)
+
                     # Check audio size limit
                     if recorded_bytes_total + len(chunk) > MAX_AUDIO_BYTES:
                         logger.warning(f"[{device_id}] Recording too large, rejecting")
@@ -66,12 +176,15 @@ async def ws_handler(ws: WebSocket):
                             "error": "recording_too_large",
                             "message": f"Recording exceeds {MAX_AUDIO_BYTES // (1024*1024)} MB limit",
                         })
-                        recorded_chunks.clear()
-                        recorded_bytes_total = 0
+                        await save_session(b"".join(recorded_chunks), {"timings_ms": {}},
+                                           error="recording_too_large")
+                        reset_recording()
                         recording_done = True
+                        recording_rejected = True
                         continue
                     recorded_chunks.append(chunk)
                     recorded_bytes_total += len(chunk)
+                    recorder.add_frame(session_rec, len(chunk))
                 continue
 
             # Text = kontrollmeddelande
@@ -85,9 +198,25 @@ async def ws_handler(ws: WebSocket):
                     continue
 
                 msg_type = data.get("type")
-                logger.info(f"[{device_id or 'unknown'}] Message type: {msg_type}")
+                if msg_type in ("ping", "pong"):
+                    logger.debug(f"[{device_id or 'unknown'}] Message type: {msg_type}")
+                else:
+                    logger.info(f"[{device_id or 'unknown'}] Message type: {msg_type}")
 
-                if msg_type == "hello":
+                if msg_type in ("ping", "pong"):
+                    client = clients.get(device_id)
+                    if client and client["ws"] is ws:
+                        client["heartbeat"] = True
+
+                if msg_type == "ping":
+                    await ws.send_json({"type": "pong", "ts": data.get("ts")})
+
+                elif msg_type == "pong":
+                    if client and client["ws"] is ws and client["ping_sent"] is not None:
+                        client["rtt_ms"] = round((time.monotonic() - client["ping_sent"]) * 1000, 1)
+                        client["ping_sent"] = None
+
+                elif msg_type == "hello":
                     # ESP32 registrerar sig
                     device_id = data.get("device_id", f"dev-{uuid.uuid4()}")
                     room = data.get("room", "unknown")
@@ -99,10 +228,27 @@ async def ws_handler(ws: WebSocket):
 
                     logger.info(f"[{device_id}] Registered: room={room}, mic={mic_sr}Hz/{mic_width*8}bit/{mic_ch}ch")
 
+                    # Samma enhet återansluten: stäng den gamla (troligen halvöppna) socketen
+                    # i bakgrunden, så att hello_ack inte väntar på en close-handskakning
+                    old = clients.get(device_id)
+                    if old and old["ws"] is not ws:
+                        task = asyncio.create_task(
+                            _close_stale(device_id, old, "Replaced by new connection")
+                        )
+                        _background_tasks.add(task)
+                        task.add_done_callback(_background_tasks.discard)
+
+                    now = datetime.utcnow()
                     clients[device_id] = {
                         "ws": ws,
                         "room": room,
-                        "last_seen": datetime.utcnow(),
+                        "connected_at": now,
+                        "last_seen": now,
+                        "busy": False,
+                        "broadcasting": False,
+                        "heartbeat": bool(data.get("heartbeat", False)),
+                        "ping_sent": None,
+                        "rtt_ms": None,
                     }
 
                     await ws.send_json({
@@ -117,6 +263,11 @@ async def ws_handler(ws: WebSocket):
 
                     recording_done = True
 
+                    # Turen är redan avvisad och ev. sparad; inget nytt fel eller no_audio-post
+                    if recording_rejected:
+                        reset_recording()
+                        continue
+
                     # Check if we have any audio
                     if not recorded_chunks:
                         await ws.send_json({
@@ -124,7 +275,10 @@ async def ws_handler(ws: WebSocket):
                             "error": "no_audio",
                             "message": "No audio data received",
                         })
-                        recording_done = False
+                        # Ingen chunk har startat någon tur, så gör det här
+                        session_rec = recorder.start_turn(device_id, room, mic_sr, mic_width, mic_ch)
+                        await save_session(b"", {"timings_ms": {}}, error="no_audio")
+                        reset_recording()
                         continue
 
                     # 1. bygg WAV av inspelad PCM
@@ -139,9 +293,8 @@ async def ws_handler(ws: WebSocket):
                             "error": "recording_too_long",
                             "message": f"Recording exceeds {MAX_AUDIO_DURATION_SEC}s limit",
                         })
-                        recorded_chunks.clear()
-                        recorded_bytes_total = 0
-                        recording_done = False
+                        await save_session(pcm_all, {"timings_ms": {}}, error="recording_too_long")
+                        reset_recording()
                         continue
 
                     wav_bytes = pcm_to_wav(
@@ -151,12 +304,26 @@ async def ws_handler(ws: WebSocket):
                         channels=mic_ch,
                     )
 
+                    # Pipelinen kan ta längre tid än idle-timeouten; hoppa över
+                    # ping/reaping under tiden
+                    set_busy(True)
+
+                    # Text, action och tider per steg (för loggning och recorder)
+                    turn = {"timings_ms": {}}
+                    pipeline_start = time.perf_counter()
+
+                    def mark(stage: str, t0: float):
+                        turn["timings_ms"][stage] = round((time.perf_counter() - t0) * 1000, 1)
+
                     try:
                         # Run pipeline with timeout
                         async def run_pipeline():
                             # 2. STT (run in thread pool to avoid blocking)
                             logger.info(f"[{device_id}] Starting STT...")
+                            t0 = time.perf_counter()
                             user_text = await asyncio.to_thread(transcribe_wav, wav_bytes)
+                            mark("stt", t0)
+                            turn["stt_text"] = user_text
                             logger.info(f"[{device_id}] STT result: '{user_text}'")
 
                             if not user_text.strip():
@@ -165,14 +332,21 @@ async def ws_handler(ws: WebSocket):
 
                             # 3. Brain (LLM) + ev. Home Assistant
                             logger.info(f"[{device_id}] Calling LLM...")
+                            t0 = time.perf_counter()
                             action_obj = await ask_llm(user_text, room)
+                            mark("llm", t0)
+                            turn["action"] = dict(action_obj)
                             logger.info(f"[{device_id}] LLM response: {action_obj}")
-                            await call_home_assistant_if_needed(action_obj)
+                            t0 = time.perf_counter()
+                            await call_home_assistant_if_needed(action_obj, room)
+                            mark("ha", t0)
                             reply_text = action_obj.get("reply", "Okej.")
 
                             # 4. TTS (reply_text -> röst)
                             logger.info(f"[{device_id}] Generating TTS for: '{reply_text}'")
+                            t0 = time.perf_counter()
                             meta, tts_chunks = await synthesize_chunks(reply_text)
+                            mark("tts", t0)
                             logger.info(f"[{device_id}] TTS done: {len(tts_chunks)} chunks")
                             return (meta, tts_chunks), reply_text
 
@@ -183,9 +357,13 @@ async def ws_handler(ws: WebSocket):
 
                         if result is None:
                             # Empty transcription - send simple response
+                            t0 = time.perf_counter()
                             meta, tts_chunks = await synthesize_chunks(reply_text)
+                            mark("tts", t0)
                         else:
                             meta, tts_chunks = result
+                        turn["reply"] = reply_text
+                        mark("total", pipeline_start)
 
                     except asyncio.TimeoutError:
                         logger.error(f"[{device_id}] Pipeline timeout after {PIPELINE_TIMEOUT_SEC}s")
@@ -194,9 +372,10 @@ async def ws_handler(ws: WebSocket):
                             "error": "pipeline_timeout",
                             "message": f"Processing timed out after {PIPELINE_TIMEOUT_SEC}s",
                         })
-                        recorded_chunks.clear()
-                        recorded_bytes_total = 0
-                        recording_done = False
+                        mark("total", pipeline_start)
+                        await save_session(pcm_all, turn, error="pipeline_timeout")
+                        reset_recording()
+                        set_busy(False)
                         continue
 
                     except Exception as e:
@@ -206,35 +385,41 @@ async def ws_handler(ws: WebSocket):
                             "error": "pipeline_error",
                             "message": "Failed to process audio",
                         })
-                        recorded_chunks.clear()
-                        recorded_bytes_total = 0
-                        recording_done = False
+                        mark("total", pipeline_start)
+                        await save_session(pcm_all, turn, error="pipeline_error")
+                        reset_recording()
+                        set_busy(False)
                         continue
 
-                    # 5. Skicka ner svaret till just den här klienten:
-                    #    Först metadata (så ESP32 kan sätta I2S-format)
-                    await ws.send_json({
-                        "type": "assistant_reply",
-                        "text": reply_text,
-                        "sample_rate": meta["sample_rate"],
-                        "sample_width": meta["sample_width"],
-                        "channels": meta["channels"],
-                    })
+                    # 5. Skicka ner svaret till just den här klienten.
+                    #    Turen sparas även om sändningen avbryts halvvägs.
+                    send_error = "send_failed"
+                    try:
+                        #    Först metadata (så ESP32 kan sätta I2S-format)
+                        await ws.send_json({
+                            "type": "assistant_reply",
+                            "text": reply_text,
+                            "sample_rate": meta["sample_rate"],
+                            "sample_width": meta["sample_width"],
+                            "channels": meta["channels"],
+                        })
 
-                    #    Sedan binära PCM16-chunks i ordning
-                    for ch_bytes in tts_chunks:
-                        await ws.send_bytes(ch_bytes)
+                        #    Sedan binära PCM16-chunks i ordning
+                        for ch_bytes in tts_chunks:
+                            await ws.send_bytes(ch_bytes)
 
-                    #    Och säg att vi är klara
-                    await ws.send_json({
-                        "type": "assistant_end"
-                    })
-                    logger.info(f"[{device_id}] Response sent successfully")
+                        #    Och säg att vi är klara
+                        await ws.send_json({
+                            "type": "assistant_end"
+                        })
+                        send_error = None
+                        logger.info(f"[{device_id}] Response sent successfully")
+                    finally:
+                        await save_session(pcm_all, turn, error=send_error)
 
                     # 6. Reset så nästa fråga kan börja utan ny socket
-                    recorded_chunks.clear()
-                    recorded_bytes_total = 0
-                    recording_done = False
+                    reset_recording()
+                    set_busy(False)
 
             # Klienten stänger
             if msg["type"] == "websocket.disconnect":
@@ -248,10 +433,15 @@ async def ws_handler(ws: WebSocket):
 
     finally:
         # Städa upp
+        reset_recording()
+        connection_count -= 1
+
         if device_id in clients and clients[device_id]["ws"] is ws:
             del clients[device_id]
 
-        if ws.client_state != WebSocketState.DISCONNECTED:
+        # Kan redan vara stängd av reapern eller en ny anslutning med samma device_id
+        if (ws.client_state != WebSocketState.DISCONNECTED
+                and ws.application_state != WebSocketState.DISCONNECTED):
             await ws.close()
 
         logger.info(f"[{device_id or 'unknown'}] Connection closed, cleanup done")
@@ -283,11 +473,16 @@ async def broadcast_tts(target_ids, text: str):
     dead_clients = []
 
     for cid in chosen:
-        ws = clients[cid]["ws"]
+        client = clients.get(cid)
+        if client is None:
+            continue
+        ws = client["ws"]
         if ws.client_state != WebSocketState.CONNECTED:
             dead_clients.append(cid)
             continue
 
+        # Ingen heartbeat-ping mitt i broadcast-strömmen
+        client["broadcasting"] = True
         try:
             # metadata först
             await ws.send_json({
@@ -310,6 +505,8 @@ async def broadcast_tts(target_ids, text: str):
         except Exception as e:
             logger.error(f"Broadcast to {cid} failed: {e}")
             dead_clients.append(cid)
+        finally:
+            client["broadcasting"] = False
 
     # rensa döda clients
     for cid in dead_clients:
@@ -320,3 +517,71 @@ async def broadcast_tts(target_ids, text: str):
                 pass
             del clients[cid]
 
+
+
+async def _close_stale(cid: str, client: dict, reason: str):
+    logger.warning(f"[{cid}] {reason}, closing stale connection")
+    if clients.get(cid) is client:
+        del clients[cid]
+    try:
+        await asyncio.wait_for(client["ws"].close(), timeout=HEARTBEAT_SEND_TIMEOUT_SEC)
+    except Exception:
+        # Halvöppen socket; handlern städar upp när receive() till slut ger upp
+        pass
+
+
+async def _heartbeat_client(cid: str, client: dict, now: datetime):
+    ws = client["ws"]
+    idle = (now - client["last_seen"]).total_seconds()
+    if WS_IDLE_TIMEOUT_SEC > 0 and idle > WS_IDLE_TIMEOUT_SEC:
+        await _close_stale(cid, client, f"No traffic for {idle:.0f}s")
+        return
+
+    if ws.client_state != WebSocketState.CONNECTED:
+        return
+
+    try:
+        client["ping_sent"] = time.monotonic()
+        await asyncio.wait_for(ws.send_json({"type": "ping"}), timeout=HEARTBEAT_SEND_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        await _close_stale(cid, client, f"Ping not sent within {HEARTBEAT_SEND_TIMEOUT_SEC}s")
+    except Exception as e:
+        logger.warning(f"[{cid}] Ping failed: {e}")
+
+
+async def heartbeat_loop():
+    """
+    Bakgrundsuppgift för enheter med heartbeat:
+    - kopplar ner de som inte hörts av på WS_IDLE_TIMEOUT_SEC
+    - skickar {"type":"ping"} till övriga och mäter RTT på deras pong
+    Alla enheter hanteras parallellt med timeout, så en hängande socket
+    blockerar inte resten. Enheter som är mitt i pipeline/svar eller en
+    broadcast lämnas ifred.
+    """
+    while True:
+        await asyncio.sleep(WS_PING_INTERVAL_SEC)
+        now = datetime.utcnow()
+
+        await asyncio.gather(*(
+            _heartbeat_client(cid, client, now)
+            for cid, client in list(clients.items())
+            if client["heartbeat"] and not client["busy"] and not client["broadcasting"]
+        ), return_exceptions=True)
+
+
+def start_heartbeat():
+    global _heartbeat_task
+    if _heartbeat_task is None:
+        _heartbeat_task = asyncio.create_task(heartbeat_loop())
+
+
+async def stop_heartbeat():
+    global _heartbeat_task
+    if _heartbeat_task is None:
+        return
+    _heartbeat_task.cancel()
+    try:
+        await _heartbeat_task
+    except asyncio.CancelledError:
+        pass
+    _heartbeat_task = None